@@ -1,16 +1,35 @@
 #!/usr/bin/env python3
 
-import configparser
 from dataclasses import dataclass
-import json
+import importlib
 import os
 from pathlib import Path
+import shlex
 import sys
 import time
 
 import click
-import psutil
-import sh
+
+
+class LazyModule:
+    """Imports the named module on first attribute access"""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        # sh replaces its own entry in sys.modules, so always go through import_module()
+        return getattr(importlib.import_module(self._name), attr)
+
+
+# Not needed for `--help`, shell completion, etc. so keep them off the startup path
+configparser = LazyModule('configparser')
+json = LazyModule('json')
+psutil = LazyModule('psutil')
+sh = LazyModule('sh')
+subprocess = LazyModule('subprocess')
+tempfile = LazyModule('tempfile')
+threading = LazyModule('threading')
 
 
 # ------------------
@@ -55,6 +74,10 @@ CACHE_DPATH = /mnt/usb-data/zor-cache
 ADMIN_USERNAME =
 # openssl passwd -1 'put password here'
 ADMIN_PASSHASH =
+
+# Cipher for the encrypted pool.  `zor cipher-bench` will recommend the fastest on this machine.
+# Options: aes-256-gcm, aes-128-gcm, aes-256-ccm, aes-128-ccm
+ENCRYPTION = aes-256-gcm
 """
 
 
@@ -68,6 +91,7 @@ class Config:
     cache_dpath: Path | None = None
     admin_username: str = ''
     admin_passhash: str = ''
+    encryption: str = 'aes-256-gcm'
     pool_name: str = ''
     efi_partname: str = ''
     efi_dev: str = ''
@@ -95,14 +119,18 @@ class Config:
         self.os_root_ds = f'{self.os_ds}/root'
 
 
-def config_prep(click_ctx):
+def config_prep(click_ctx, write_tpl=True):
     config_fpath = CWD / 'zor-config.ini'
     config = configparser.ConfigParser()
 
-    if not config_fpath.exists():
+    if config_fpath.exists():
+        config.read(config_fpath)
+    elif write_tpl:
         config_fpath.write_text(config_tpl)
+        config.read(config_fpath)
+    else:
+        config.read_string(config_tpl)
 
-    config.read(config_fpath)
     return Config(
         disk_dev=config['zor']['DISK_DEV'],
         disk_label=config['zor']['DISK_LABEL'],
@@ -112,6 +140,8 @@ def config_prep(click_ctx):
         cache_dpath=config['zor']['CACHE_DPATH'],
         admin_username=config['zor']['ADMIN_USERNAME'],
         admin_passhash=config['zor']['ADMIN_PASSHASH'],
+        # Added after the template, so may be missing from existing config files
+        encryption=config['zor'].get('ENCRYPTION', 'aes-256-gcm'),
     )
 
 
@@ -185,6 +215,9 @@ class Paths:
 
 paths = Paths()
 
+# Datasets directly under the pool that zfs_create() makes and aren't specific to an OS install
+shared_ds_names = ('docker', 'home', 'root', 'postgresql', 'shared')
+
 # ------------------
 # Utilities
 # ------------------
@@ -198,12 +231,85 @@ class Partitions:
     def is_mounted(self, fspath):
         return str(fspath) in self.mounts
 
+    def mount(self, fspath, *args):
+        if self.is_mounted(fspath):
+            print(f'Already mounted: {fspath}')
+            return
+        sh.mount(*args)
+
     def unmount(self, fspath):
         if self.is_mounted(fspath):
             print(f'Unmounting: {fspath}')
             sh.umount('-Rn', fspath)
 
 
+@dataclass
+class ChrootResult:
+    cmd: str
+    exit_code: int
+    output: str
+
+
+class ChrootShell:
+    """
+    One long-lived shell inside the chroot that commands are sent to over a pipe.  Saves
+    spawning a chroot process per command.
+
+    Used like a baked sh.chroot, e.g. `chroot.useradd(...)` or `chroot('ln', ...)`.  Output is
+    streamed to stdout and a disallowed exit code raises sh's ErrorReturnCode_<code>.
+
+    Commands run with stdin from /dev/null, so anything interactive should still use sh.chroot.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.proc = None
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(
+            ['chroot', str(self.root), '/bin/sh'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self(name, *args, **kwargs)
+
+    def __call__(self, *args, _ok_code=(0,)):
+        cmd = shlex.join(str(arg) for arg in args)
+        # Printed by the shell after the command completes, followed by its exit code
+        marker = f'zor-exit-{os.urandom(16).hex()}'
+        self.proc.stdin.write(f'{cmd} </dev/null 2>&1; echo "{marker} $?"\n')
+        self.proc.stdin.flush()
+
+        output = []
+        for line in self.proc.stdout:
+            # Command output without a trailing newline puts the marker on the same line
+            text, _, exit_code = line.partition(marker)
+            output.append(text)
+            sys.stdout.write(text)
+            if exit_code:
+                break
+        else:
+            raise RuntimeError(f'Chroot shell exited while running: {cmd}')
+        sys.stdout.flush()
+
+        result = ChrootResult(cmd=cmd, exit_code=int(exit_code), output=''.join(output))
+        if result.exit_code not in _ok_code:
+            exc_class = getattr(sh, f'ErrorReturnCode_{result.exit_code}')
+            raise exc_class(f'chroot {self.root} {cmd}', result.output.encode(), b'')
+        return result
+
+
 def memtest_extract():
     zip_fpath = config.cache_dpath / 'memtest86-usb.zip'
     unzip_fpath = config.cache_dpath / 'memtest86-usb'
@@ -245,11 +351,8 @@ def zfs_create(wipe_first):
         unmount_everything()
         print('destroying')
         sh.zfs.destroy('-R', os_ds, _ok_code=[0, 1])
-        sh.zfs.destroy('-R', f'{config.pool_name}/docker', _ok_code=[0, 1])
-        sh.zfs.destroy('-R', f'{config.pool_name}/home', _ok_code=[0, 1])
-        sh.zfs.destroy('-R', f'{config.pool_name}/root', _ok_code=[0, 1])
-        sh.zfs.destroy('-R', f'{config.pool_name}/postgresql', _ok_code=[0, 1])
-        sh.zfs.destroy('-R', f'{config.pool_name}/shared', _ok_code=[0, 1])
+        for ds_name in shared_ds_names:
+            sh.zfs.destroy('-R', f'{config.pool_name}/{ds_name}', _ok_code=[0, 1])
         sh.rm('-rf', paths.zroot)
 
     # --------------------
@@ -342,11 +445,12 @@ def zfs_create(wipe_first):
 
 
 def other_mounts():
-    sh.mount(config.boot_dev, f'{paths.zroot}/boot')
-    sh.mount('--rbind', '/dev', f'{paths.zroot}/dev', '--make-rslave')
-    sh.mount('--rbind', '/proc', f'{paths.zroot}/proc', '--make-rslave')
-    sh.mount('--rbind', '/sys', f'{paths.zroot}/sys', '--make-rslave')
-    sh.mount('--bind', paths.apt_cache_host, paths.apt_cache)
+    partitions = Partitions()
+    partitions.mount(paths.boot, config.boot_dev, paths.boot)
+    partitions.mount(paths.dev, '--rbind', '/dev', paths.dev, '--make-rslave')
+    partitions.mount(paths.proc, '--rbind', '/proc', paths.proc, '--make-rslave')
+    partitions.mount(paths.sys, '--rbind', '/sys', paths.sys, '--make-rslave')
+    partitions.mount(paths.apt_cache, '--bind', paths.apt_cache_host, paths.apt_cache)
 
 
 def unmount_everything():
@@ -369,6 +473,267 @@ def unmount_everything():
     print('Unmounted everything')
 
 
+def prop_get(tool, name, prop):
+    """
+    Value of a property from `zfs get` or `zpool get`, e.g. `prop_get(sh.zpool, pool, 'altroot')`,
+    or None if the dataset or pool isn't available.
+    """
+    cmd = tool.get('-H', '-o', 'value', prop, name, _ok_code=[0, 1], _return_cmd=True)
+    return str(cmd).strip() if cmd.exit_code == 0 else None
+
+
+def pool_import():
+    """Import only our pool, probing only our partition instead of scanning every device"""
+    altroot = prop_get(sh.zpool, config.pool_name, 'altroot')
+
+    if altroot == str(paths.zroot):
+        print('Pool already imported:', config.pool_name)
+        return
+
+    if altroot is not None:
+        # Imported but not under our altroot, e.g. auto-imported by the live environment
+        sh.zpool.export(config.pool_name, _fg=True)
+
+    sh.zpool('import', '-Nf', '-d', config.zfs_dev, '-R', paths.zroot, config.pool_name, _fg=True)
+
+
+class RingBuffer:
+    """
+    Fixed size byte buffer between one producer and one consumer thread so that neither side
+    of a stream has to wait for the other on every read or write.
+    """
+
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.size = size
+        self.start = 0
+        self.used = 0
+        self.closed = False
+        self.aborted = False
+        self.cond = threading.Condition()
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            with self.cond:
+                while self.used == self.size and not self.aborted:
+                    self.cond.wait()
+                if self.aborted:
+                    raise BrokenPipeError('Ring buffer consumer went away')
+                end = (self.start + self.used) % self.size
+                count = min(len(view), self.size - self.used, self.size - end)
+                self.buf[end : end + count] = view[:count]
+                self.used += count
+                self.cond.notify()
+            view = view[count:]
+
+    def read(self, max_count):
+        """Read up to max_count bytes.  Returns b'' once closed and drained."""
+        with self.cond:
+            while self.used == 0 and not self.closed:
+                self.cond.wait()
+            if self.used == 0:
+                return b''
+            count = min(max_count, self.used, self.size - self.start)
+            data = bytes(self.buf[self.start : self.start + count])
+            self.start = (self.start + count) % self.size
+            self.used -= count
+            self.cond.notify()
+            return data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def abort(self):
+        with self.cond:
+            self.aborted = True
+            self.cond.notify_all()
+
+
+def stream_pump(src, dst, buffer_size, chunk_size=1024**2):
+    """Copy src to dst through a RingBuffer, returns the number of bytes copied"""
+    ring = RingBuffer(buffer_size)
+    errors = []
+
+    def produce():
+        try:
+            chunk = bytearray(chunk_size)
+            while count := src.readinto(chunk):
+                ring.write(chunk[:count])
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            ring.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    total = 0
+    last_report = start = time.monotonic()
+    try:
+        while data := ring.read(chunk_size):
+            dst.write(data)
+            total += len(data)
+            if time.monotonic() - last_report > 10:
+                last_report = time.monotonic()
+                print(f'    {throughput(total, last_report - start)}')
+    finally:
+        ring.abort()
+        producer.join()
+
+    if errors:
+        raise errors[0]
+    return total
+
+
+def throughput(byte_count, seconds):
+    mib = byte_count / 1024**2
+    return f'{mib:,.1f} MiB in {seconds:.1f}s ({mib / max(seconds, 0.001):,.1f} MiB/s)'
+
+
+def zfs_snapshots(*datasets, ok_codes=(0,)):
+    """Map of dataset name to its snapshot names, oldest first"""
+    cmd = sh.zfs.list(
+        '-H',
+        '-o',
+        'name',
+        '-t',
+        'snapshot',
+        '-s',
+        'createtxg',
+        '-r',
+        *datasets,
+        _ok_code=ok_codes,
+        _return_cmd=True,
+    )
+    snapshots = {}
+    for line in str(cmd).splitlines():
+        ds, snap = line.strip().split('@')
+        snapshots.setdefault(ds, []).append(snap)
+    return snapshots
+
+
+def zfs_send(send_args, dst_ds=None, dst_fpath=None, buffer_size=64 * 1024**2):
+    """
+    Run `zfs send <send_args>` into `zfs receive` for dst_ds, or into the file dst_fpath.
+    Returns bytes sent.
+    """
+    send_cmd = ['zfs', 'send', *send_args]
+    send = subprocess.Popen(send_cmd, stdout=subprocess.PIPE)
+
+    if dst_ds:
+        # -u: don't mount what's received.  No -s, replication streams can't be resumed.
+        recv_cmd = ['zfs', 'receive', '-u', dst_ds]
+        recv = subprocess.Popen(recv_cmd, stdin=subprocess.PIPE)
+        dst = recv.stdin
+    else:
+        recv = None
+        dst = dst_fpath.open('wb')
+
+    pipe_error = None
+    try:
+        with send.stdout, dst:
+            byte_count = stream_pump(send.stdout, dst, buffer_size)
+    except BrokenPipeError as e:
+        # receive exited early, its exit code below says why
+        pipe_error = e
+    finally:
+        # Always reap both, even when something else is already propagating
+        send.wait()
+        if recv:
+            recv.wait()
+
+    # A failed receive makes send fail too, so report the cause first
+    if recv and recv.returncode != 0:
+        raise subprocess.CalledProcessError(recv.returncode, recv_cmd) from pipe_error
+    if send.returncode != 0:
+        raise subprocess.CalledProcessError(send.returncode, send_cmd) from pipe_error
+    if pipe_error:
+        raise pipe_error
+
+    return byte_count
+
+
+# Ciphers ZFS supports.  Earlier entries win ties in cipher-bench.
+encryption_ciphers = ('aes-256-gcm', 'aes-128-gcm', 'aes-256-ccm', 'aes-128-ccm')
+# Where the ICP (ZFS crypto) parameters are depends on whether the ZFS build has icp as its own
+# module or built into zfs.ko
+icp_params_dpaths = (Path('/sys/module/icp/parameters'), Path('/sys/module/zfs/parameters'))
+
+
+def icp_params_find():
+    """Directory holding the icp_*_impl parameters or None if ZFS doesn't have them"""
+    for dpath in icp_params_dpaths:
+        if dpath.joinpath('icp_gcm_impl').exists():
+            return dpath
+    return None
+
+
+def icp_impls(params_dpath, param):
+    """
+    Implementations available for an icp module parameter, e.g. icp_gcm_impl, and the one
+    currently selected.
+    """
+    # Looks like: cycle [fastest] avx generic pclmulqdq
+    words = params_dpath.joinpath(param).read_text().split()
+    selected = next(word.strip('[]') for word in words if word.startswith('['))
+    # cycle and fastest are selection strategies, not implementations
+    impls = [word.strip('[]') for word in words if word.strip('[]') not in ('cycle', 'fastest')]
+    return impls, selected
+
+
+def cpu_flags():
+    for line in Path('/proc/cpuinfo').read_text().splitlines():
+        if line.startswith('flags'):
+            return set(line.split(':', 1)[1].split())
+    return set()
+
+
+def cipher_throughput(pool_name, cipher, key_fpath, data, size):
+    """Write then read size bytes in a new dataset encrypted with cipher, returns MiB/s of each"""
+    ds = f'{pool_name}/{cipher}'
+    sh.zfs.create(
+        '-o',
+        f'encryption={cipher}',
+        '-o',
+        'keyformat=raw',
+        '-o',
+        f'keylocation=file://{key_fpath}',
+        # Measure encryption, not compression or the ARC
+        '-o',
+        'compression=off',
+        '-o',
+        'primarycache=metadata',
+        '-o',
+        'recordsize=1M',
+        ds,
+    )
+    try:
+        fpath = Path(sh.zfs.get('-H', '-o', 'value', 'mountpoint', ds).strip()) / 'bench'
+
+        start = time.monotonic()
+        with fpath.open('wb') as fo:
+            for _ in range(size // len(data)):
+                fo.write(data)
+            fo.flush()
+            os.fsync(fo.fileno())
+        write_secs = time.monotonic() - start
+
+        start = time.monotonic()
+        with fpath.open('rb', buffering=0) as fo:
+            chunk = bytearray(len(data))
+            while fo.readinto(chunk):
+                pass
+        read_secs = time.monotonic() - start
+    finally:
+        sh.zfs.destroy(ds)
+
+    mib = size / 1024**2
+    return mib / write_secs, mib / read_secs
+
+
 def kernels_in_boot():
     boot_dpath = Path(f'{paths.zroot}/boot')
     kernel_fpaths = boot_dpath.glob('vmlinuz-*')
@@ -383,26 +748,63 @@ def kernels_in_boot():
 # ------------------
 
 
-@click.group()
-@click.pass_context
-def zor(ctx):
-    global config
-    config = config_prep(ctx)
+def config_use(use):
+    """
+    Mark how a command uses the config, put it above @zor.command():
+
+        none:   never reads it, so it isn't loaded
+        read:   only reports, so a missing config file isn't written from the template
+
+    Unmarked commands read the config and write the template if the file is missing.
+    """
+
+    def decorator(cmd):
+        cmd.config_use = use
+        return cmd
 
-    if os.getuid() != 0:
-        ctx.fail('You must be root')
+    return decorator
 
 
+class ZorCommand(click.Command):
+    """
+    Checks for root and loads the config only once the command's arguments are parsed, so
+    `--help` and shell completion never get that far.
+    """
+
+    def invoke(self, ctx):
+        if os.getuid() != 0:
+            ctx.fail('You must be root')
+
+        use = getattr(self, 'config_use', 'write')
+        global config
+        if use != 'none':
+            config = config_prep(ctx, write_tpl=use == 'write')
+
+        return super().invoke(ctx)
+
+
+class ZorGroup(click.Group):
+    command_class = ZorCommand
+
+
+@click.group(cls=ZorGroup)
+def zor():
+    pass
+
+
+@config_use('read')
 @zor.command('config')
 def _config():
     print(config)
 
 
+@config_use('none')
 @zor.command()
 def kernel_versions():
     print(kernels_in_boot())
 
 
+@config_use('read')
 @zor.command()
 def status():
     print('Config values --------------------\n')
@@ -433,10 +835,17 @@ def status():
 @click.option('--chroot', is_flag=True, default=False)
 def recover(chroot):
     """Import pool and mount filesystem in prep for recovery efforts"""
-    sh.zpool.export('-a', _fg=True)
-    sh.zpool('import', '-Nf', '-R', paths.zroot, config.pool_name, _fg=True)
-    sh.zfs('load-key', '-a', _fg=True)
-    sh.zfs.mount(config.os_root_ds, _fg=True)
+    pool_import()
+
+    if prop_get(sh.zfs, config.pool_name, 'keystatus') == 'available':
+        print('Key already loaded for:', config.pool_name)
+    else:
+        sh.zfs('load-key', config.pool_name, _fg=True)
+
+    if prop_get(sh.zfs, config.os_root_ds, 'mounted') == 'yes':
+        print('Already mounted:', config.os_root_ds)
+    else:
+        sh.zfs.mount(config.os_root_ds, _fg=True)
     sh.zfs.mount('-a', _fg=True)
 
     efi_mount()
@@ -458,6 +867,7 @@ def efi_mount():
     sh.mount(config.efi_dev, paths.efi_mnt)
 
 
+@config_use('none')
 @zor.command()
 def chroot():
     """Import pool and mount filesystem in prep for recovery efforts"""
@@ -594,7 +1004,7 @@ def zpool(wipe_first):
         '-O',
         'xattr=sa',
         '-O',
-        'encryption=aes-256-gcm',
+        f'encryption={config.encryption}',
         '-O',
         'keylocation=prompt',
         '-O',
@@ -674,32 +1084,30 @@ def install_os(wipe_first):
 
     # Customize OS in chroot
     # ----------------------
-    chroot = sh.chroot.bake(paths.zroot)
-
-    chroot('apt', 'update')
+    with ChrootShell(paths.zroot) as chroot:
+        chroot('apt', 'update')
 
-    chroot('locale-gen', '--purge', 'en_US.UTF-8', _fg=True)
-    chroot('update-locale', LANG='en_US.UTF-8', LANGUAGE='en_US:en', _fg=True)
+        chroot('locale-gen', '--purge', 'en_US.UTF-8')
+        chroot('update-locale', 'LANG=en_US.UTF-8', 'LANGUAGE=en_US:en')
 
-    chroot('ln', '-fs', '/usr/share/zoneinfo/US/Eastern', '/etc/localtime', _fg=True)
-    chroot('dpkg-reconfigure', '-f', 'noninteractive', 'tzdata', _fg=True)
+        chroot('ln', '-fs', '/usr/share/zoneinfo/US/Eastern', '/etc/localtime')
+        chroot('dpkg-reconfigure', '-f', 'noninteractive', 'tzdata')
 
-    # Have to install the kernel and zfs-initramfs so that ZFS is installed and creating the user's
-    # dataset below works.
-    chroot('apt', 'install', '--yes', '--no-install-recommends', 'linux-image-generic', _fg=True)
-    chroot('apt', 'install', '--yes', 'zfs-initramfs', _fg=True)
+        # Have to install the kernel and zfs-initramfs so that ZFS is installed and creating the
+        # user's dataset below works.  Installs run in the foreground as they can prompt.
+        chroot_fg = sh.chroot.bake(paths.zroot, _fg=True)
+        chroot_fg('apt', 'install', '--yes', '--no-install-recommends', 'linux-image-generic')
+        chroot_fg('apt', 'install', '--yes', 'zfs-initramfs')
 
-    # `update-initramfs -uk all` doesn't work, see:
-    # https://bugs.launchpad.net/ubuntu/+source/initramfs-tools/+bug/1829805
-    for kernel_version in kernels_in_boot():
-        chroot('update-initramfs', '-uk', kernel_version, _fg=True)
+        # `update-initramfs -uk all` doesn't work, see:
+        # https://bugs.launchpad.net/ubuntu/+source/initramfs-tools/+bug/1829805
+        for kernel_version in kernels_in_boot():
+            chroot('update-initramfs', '-uk', kernel_version)
 
 
 @zor.command('install-user')
 @click.option('--wipe-first', is_flag=True, default=False)
 def install_user(wipe_first):
-    chroot = sh.chroot.bake(paths.zroot)
-
     username = config.admin_username
     passhash = config.admin_passhash
 
@@ -707,26 +1115,27 @@ def install_user(wipe_first):
     # /home is already a dedicated dataset.
     # user_dataset = f'{config.pool_name}/home/{username}'
 
-    if wipe_first:
-        # chroot.zfs.umount(user_dataset, _ok_code=[0,1])
-        chroot.userdel(username, '--remove', _ok_code=[0, 6])
-        # chroot.zfs.destroy('-R', user_dataset, _ok_code=[0,1])
-
-    # Create user dataset
-    # sh.zfs.create(user_dataset)
-
-    chroot.useradd('--create-home', '--shell', '/bin/bash', '-p', passhash, username)
-
-    chroot.addgroup('--system', 'docker')
-    chroot.addgroup('--system', 'lpadmin')
-    chroot.addgroup('--system', 'netdev')
-    chroot.addgroup('--system', 'sambashare')
-    chroot.usermod(
-        '-a',
-        '-G',
-        'adm,cdrom,dip,docker,lpadmin,netdev,plugdev,sambashare,sudo',
-        username,
-    )
+    with ChrootShell(paths.zroot) as chroot:
+        if wipe_first:
+            # chroot.zfs.umount(user_dataset, _ok_code=[0,1])
+            chroot.userdel(username, '--remove', _ok_code=[0, 6])
+            # chroot.zfs.destroy('-R', user_dataset, _ok_code=[0,1])
+
+        # Create user dataset
+        # sh.zfs.create(user_dataset)
+
+        chroot.useradd('--create-home', '--shell', '/bin/bash', '-p', passhash, username)
+
+        chroot.addgroup('--system', 'docker')
+        chroot.addgroup('--system', 'lpadmin')
+        chroot.addgroup('--system', 'netdev')
+        chroot.addgroup('--system', 'sambashare')
+        chroot.usermod(
+            '-a',
+            '-G',
+            'adm,cdrom,dip,docker,lpadmin,netdev,plugdev,sambashare,sudo',
+            username,
+        )
 
 
 @zor.command('install-desktop')
@@ -779,5 +1188,193 @@ def install(ctx: click.Context, desktop: str, inspect: bool):
         print('Inspection requested.  Run `zor unmount` before rebooting.')
 
 
+@zor.command()
+@click.option('--to-ds', help='Dataset to receive into, e.g. backuppool/sampro')
+@click.option(
+    '--to-dir',
+    type=click.Path(file_okay=False, path_type=Path),
+    help='Directory for stream files',
+)
+@click.option(
+    '--buffer-mb',
+    default=64,
+    help='Size of the in-memory buffer between send and receive',
+)
+@click.pass_context
+def replicate(ctx: click.Context, to_ds: str | None, to_dir: Path | None, buffer_mb: int):
+    """
+    Snapshot the OS and shared datasets and send raw (still encrypted) incremental streams
+    to another pool or a directory of stream files.
+
+    Only what changed since the last replication is sent.  Each top dataset goes as one
+    replication stream so its children keep inheriting its encryption.
+    """
+    if bool(to_ds) == bool(to_dir):
+        ctx.fail('Give exactly one of --to-ds or --to-dir')
+
+    buffer_size = buffer_mb * 1024**2
+    top_datasets = [config.os_ds] + [f'{config.pool_name}/{name}' for name in shared_ds_names]
+
+    snap = 'zor-' + time.strftime('%Y%m%d-%H%M%S')
+    sh.zfs.snapshot('-r', *[f'{ds}@{snap}' for ds in top_datasets])
+    print('Snapshot taken:', snap)
+
+    src_snaps = zfs_snapshots(*top_datasets)
+    dst_snaps = zfs_snapshots(to_ds, ok_codes=(0, 1)) if to_ds else {}
+    if to_ds:
+        # zfs receive doesn't create missing parents of the dataset it receives into
+        sh.zfs.create('-p', '-o', 'canmount=off', f'{to_ds}/{config.pool_name}')
+    else:
+        to_dir.mkdir(parents=True, exist_ok=True)
+
+    total = 0
+    total_start = time.monotonic()
+    for ds in top_datasets:
+        # -R sends the children's snapshots along with the top dataset's, so the top one decides
+        ours = [s for s in src_snaps.get(ds, ()) if s.startswith('zor-') and s != snap]
+        if to_ds:
+            dst_ds = f'{to_ds}/{ds}'
+            common = [s for s in ours if s in dst_snaps.get(dst_ds, ())]
+        else:
+            stream_fname = ds.replace('/', '__') + '@{}.zstream'
+            common = [s for s in ours if to_dir.joinpath(stream_fname.format(s)).exists()]
+
+        # A raw per dataset send would make each received dataset its own encryption root
+        send_args = ['-w', '-R']
+        if common:
+            send_args += ['-I', f'@{common[-1]}']
+        send_args.append(f'{ds}@{snap}')
+
+        print(f'Sending: {ds}@{snap}', f'(since @{common[-1]})' if common else '(full)')
+        start = time.monotonic()
+        if to_ds:
+            if not common and dst_ds in dst_snaps:
+                ctx.fail(f'{dst_ds} exists but has no snapshot in common with {ds}')
+            byte_count = zfs_send(send_args, dst_ds=dst_ds, buffer_size=buffer_size)
+        else:
+            # Only completed streams get their final name so later runs can build on them
+            stream_fpath = to_dir / stream_fname.format(snap)
+            part_fpath = stream_fpath.with_suffix('.part')
+            byte_count = zfs_send(send_args, dst_fpath=part_fpath, buffer_size=buffer_size)
+            part_fpath.rename(stream_fpath)
+        print('   ', throughput(byte_count, time.monotonic() - start))
+        total += byte_count
+
+    print('Replication complete:', throughput(total, time.monotonic() - total_start))
+
+
+@config_use('read')
+@zor.command('cipher-bench')
+@click.option(
+    '--size-mb',
+    # Less than the 8 MiB written at a time would write nothing
+    type=click.IntRange(min=8),
+    default=512,
+    help='Data written and read per cipher & implementation',
+)
+@click.option(
+    '--apply',
+    is_flag=True,
+    help="Tune the installed system to the fastest implementation for its pool's cipher",
+)
+@click.pass_context
+def cipher_bench(ctx: click.Context, size_mb: int, apply: bool):
+    """
+    Benchmark pool encryption ciphers on a throwaway file-backed pool with each of the ZFS
+    accelerated implementations available and recommend the fastest.
+    """
+    if apply:
+        if not paths.zroot.joinpath('etc').exists():
+            ctx.fail(f'--apply needs the installed system mounted at: {paths.zroot}')
+        # Tune for the cipher the pool actually uses, whichever cipher wins here
+        pool_cipher = prop_get(sh.zfs, config.pool_name, 'encryption')
+        if pool_cipher not in encryption_ciphers:
+            ctx.fail(f'--apply needs an encrypted, imported pool: {config.pool_name}')
+
+    params_dpath = icp_params_find()
+    if params_dpath is None:
+        searched = ', '.join(str(dpath) for dpath in icp_params_dpaths)
+        ctx.fail(f'ZFS crypto parameters not found in: {searched}.  Is the zfs module loaded?')
+
+    flags = cpu_flags()
+    wanted = ('aes', 'pclmulqdq', 'avx', 'avx2', 'movbe', 'vaes', 'vpclmulqdq')
+    print('CPU flags:', ' '.join(f'{flag}={"yes" if flag in flags else "no"}' for flag in wanted))
+    if 'aes' not in flags:
+        print('WARNING: no AES-NI, all ciphers will use the much slower generic implementation')
+
+    # gcm ciphers use icp_gcm_impl, ccm ciphers use icp_aes_impl
+    impl_params = {'gcm': 'icp_gcm_impl', 'ccm': 'icp_aes_impl'}
+    impls = {mode: icp_impls(params_dpath, param) for mode, param in impl_params.items()}
+    for mode, (available, selected) in impls.items():
+        print(f'{impl_params[mode]}: {" ".join(available)} (selected: {selected})')
+
+    pool_name = 'zor-cipher-bench'
+    size = size_mb * 1024**2
+    data = os.urandom(8 * 1024**2)
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix='zor-cipher-bench-') as tmp_dpath:
+        tmp_dpath = Path(tmp_dpath)
+        key_fpath = tmp_dpath / 'key'
+        key_fpath.write_bytes(os.urandom(32))
+        vdev_fpath = tmp_dpath / 'vdev'
+        # Sparse, so only what's written takes up space
+        with vdev_fpath.open('wb') as fo:
+            fo.truncate(max(size * 2, 256 * 1024**2))
+
+        sh.zpool.create('-R', tmp_dpath / 'root', pool_name, vdev_fpath)
+        try:
+            try:
+                for cipher in encryption_ciphers:
+                    mode = cipher.rsplit('-', 1)[1]
+                    param_fpath = params_dpath / impl_params[mode]
+                    for impl in impls[mode][0]:
+                        param_fpath.write_text(impl)
+                        write_mibs, read_mibs = cipher_throughput(
+                            pool_name,
+                            cipher,
+                            key_fpath,
+                            data,
+                            size,
+                        )
+                        print(
+                            f'{cipher:<12} {impl:<10} write {write_mibs:>8,.0f} MiB/s'
+                            f'  read {read_mibs:>8,.0f} MiB/s',
+                        )
+                        results.append((min(write_mibs, read_mibs), cipher, impl))
+            finally:
+                # Restore first so the host isn't left on a benchmarked impl if destroy fails
+                for mode, param in impl_params.items():
+                    params_dpath.joinpath(param).write_text(impls[mode][1])
+        finally:
+            sh.zpool.destroy(pool_name)
+
+    # max() keeps the first of equal results, i.e. the earlier listed cipher
+    mibs, cipher, impl = max(results, key=lambda result: result[0])
+    param = impl_params[cipher.rsplit('-', 1)[1]]
+    print(f'\nFastest: {cipher} with {param}={impl} ({mibs:,.0f} MiB/s)')
+    print(f'Set ENCRYPTION = {cipher} in {CWD / "zor-config.ini"} before running `zor zpool`')
+
+    if apply:
+        pool_results = [result for result in results if result[1] == pool_cipher]
+        mibs, _, pool_impl = max(pool_results, key=lambda result: result[0])
+        pool_param = impl_params[pool_cipher.rsplit('-', 1)[1]]
+        print(
+            f'Fastest for pool cipher {pool_cipher}: {pool_param}={pool_impl}',
+            f'({mibs:,.0f} MiB/s)',
+        )
+
+        # tmpfiles.d sets the sysfs parameter at boot, the same way it's set above
+        conf_fpath = paths.zroot / 'etc/tmpfiles.d/zor-icp.conf'
+        conf_fpath.parent.mkdir(exist_ok=True)
+        conf_line = f'w {params_dpath / pool_param} - - - - {pool_impl}\n'
+        conf_fpath.write_text(f'# Written by `zor cipher-bench`\n{conf_line}')
+        print('Wrote:', conf_fpath)
+
+
+def main():
+    zor(prog_name='zor')
+
+
 if __name__ == '__main__':
-    zor()
+    main()